@@ -8,3 +8,5 @@ OUTPUT_COLLECTION_ROOT = os.environ.get(
 )
 VERSION = "0.1.0"
 NODATA = 255
+# The number of scenes to process at once
+SCENE_WORKERS = int(os.environ.get("FC_SCENE_WORKERS", 4))
@@ -1,16 +1,20 @@
 """Create annual summaries from scene-level fractional cover."""
 
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
 from typing_extensions import Annotated
 
 import boto3
+import dask
 from distributed import Client
 import numpy as np
-from odc.algo import keep_good_only, mask_cleanup
+from odc.algo import keep_good_only
 from odc.geo import GeoBox
+from odc.stac import configure_rio
 from odc.stats.plugins.fc_percentiles import StatsFCP
+from pystac import Item
 from typer import Option, run
-from xarray import Dataset, merge
+from xarray import Dataset, apply_ufunc, merge
 
 from cloud_logger import CsvLogger, S3Handler
 from dep_tools.exceptions import EmptyCollectionError
@@ -18,44 +22,148 @@ from dep_tools.loaders import OdcLoader, StacLoader
 from dep_tools.namers import S3ItemPath
 from dep_tools.parsers import bool_parser
 from dep_tools.processors import XrPostProcessor
-from dep_tools.searchers import PystacSearcher
+from dep_tools.searchers import PystacSearcher, Searcher
 from dep_tools.stac_utils import StacCreator
 from dep_tools.task import AwsStacTask as Task
 from dep_tools.utils import mask_to_gadm
 from dep_tools.writers import AwsDsCogWriter
 
 from config import BUCKET, OUTPUT_COLLECTION_ROOT, NODATA, VERSION
-from grid import grid
+from fast_morph import mask_cleanup
+from grid import get_geobox, within_gadm
+
+
+@lru_cache
+def _wofl_lookup(bad_bits: tuple[int, ...]) -> np.ndarray:
+    # The flags returned by _decode_wofl, for every possible WOfS value
+    values = np.arange(256, dtype=np.uint8)
+    # not mask against bit 4: terrain high slope
+    # This is why a subclass was needed: without casting the bitmask to
+    # uint8, the inversion (~) created a negative number. It must
+    # compare to the left operand and has trouble with a dask array?
+    mask = values & ~np.uint8(1 << 4)
+    # Pick out the dry and wet pixels
+    return np.stack(
+        [mask == 0, mask == 128, *((values & bits) > 0 for bits in bad_bits)]
+    )
+
+
+def _decode_wofl(water: np.ndarray, bad_bits: list[int]) -> tuple[np.ndarray, ...]:
+    """Decode a WOfS bitmask into boolean flags.
+
+    WOfS is uint8, so all flags are looked up from a 256 entry table in a
+    single pass, rather than testing bits separately.
+
+    Args:
+        water: WOFL data.
+        bad_bits: Bitmasks to test for, e.g. cloud or cloud shadow.
+
+    Returns:
+        Dry pixels, wet pixels, then one array per entry in `bad_bits` which
+        is True where any of its bits are set.
+    """
+    return tuple(_wofl_lookup(tuple(bad_bits))[:, water])
+
+
+def _sum_valid(*bands: np.ndarray, nodata: int) -> np.ndarray:
+    """Sum bands, treating `nodata` as zero.
+
+    The sum is accumulated in place as uint16, so uint8 bands can't overflow
+    and no masked copy of each band is made.
+    """
+    total = np.zeros(bands[0].shape, dtype=np.uint16)
+    for band in bands:
+        np.add(total, band, out=total, where=band != nodata)
+    return total
+
+
+def _clip_valid(band: np.ndarray, low: int, high: int, nodata: int) -> np.ndarray:
+    """Clip a band to [`low`, `high`], leaving `nodata` values unchanged."""
+    clipped = np.clip(band, low, high)
+    # Set masked values back to NODATA
+    np.copyto(clipped, band, where=band == nodata)
+    return clipped
+
+
+def _fill_nan(data: np.ndarray, nodata: int) -> np.ndarray:
+    """Convert to uint8, setting NaNs to `nodata`.
+
+    Floating point data is written straight into the uint8 output, rather
+    than filling in a float copy first.
+    """
+    if not np.issubdtype(data.dtype, np.floating):
+        return data.astype(np.uint8, copy=False)
+    output = np.full(data.shape, nodata, dtype=np.uint8)
+    np.copyto(output, data, casting="unsafe", where=~np.isnan(data))
+    return output
+
+
+class MultiCollectionSearcher(Searcher):
+    """Searches each collection separately, returning the items grouped by
+    collection. The searches are run concurrently.
+
+    Args:
+        collections: The collections to search.
+        **kwargs: Passed to :class:`dep_tools.searchers.PystacSearcher`.
+    """
+
+    def __init__(self, collections: list[str], **kwargs):
+        self._searchers = {
+            collection: PystacSearcher(collections=[collection], **kwargs)
+            for collection in collections
+        }
+
+    def search(self, area) -> dict[str, list[Item]]:
+        def search_collection(searcher):
+            try:
+                return list(searcher.search(area))
+            except EmptyCollectionError:
+                # Missing collections are handled by the loader
+                return []
+
+        with ThreadPoolExecutor(max_workers=len(self._searchers)) as executor:
+            futures = {
+                collection: executor.submit(search_collection, searcher)
+                for collection, searcher in self._searchers.items()
+            }
+            return {
+                collection: future.result() for collection, future in futures.items()
+            }
 
 
 class MultiCollectionLoader(StacLoader):
     """Allows loading of data from multiple collections into the same dataset.
     The sets of items in each collection should have the same dimensions (x, y & time),
-    but can have different variables."""
+    but can have different variables. Items should be grouped by collection, as
+    returned by :class:`MultiCollectionSearcher`."""
 
     def __init__(self, fill_value=NODATA, **kwargs):
         self._fill_value = fill_value
-        self._kwargs = kwargs
+        # The same loader is used for each collection
+        self._loader = OdcLoader(**kwargs)
 
-    def load(self, items, areas) -> Dataset:
-        # split collections
-        collections = defaultdict(list)
-        for item in items:
-            collections[item.collection_id].append(item)
+    def load(self, items: dict[str, list[Item]], areas) -> Dataset:
+        collections = {
+            collection: these_items
+            for collection, these_items in items.items()
+            if len(these_items) > 0
+        }
 
         if not "dep_ls_fc" in collections:
             raise EmptyCollectionError("No fractional cover items found")
         elif not "dep_ls_wofl" in collections:
             raise EmptyCollectionError("No WOFL items found")
 
-        # load items in each and merge
-        return merge(
-            [
-                OdcLoader(**self._kwargs).load(items, areas)
-                for items in collections.values()
-            ],
-            fill_value=self._fill_value,
-        )
+        # load items in each concurrently and merge
+        with ThreadPoolExecutor(max_workers=len(collections)) as executor:
+            futures = [
+                executor.submit(self._loader.load, these_items, areas)
+                for these_items in collections.values()
+            ]
+            return merge(
+                [future.result() for future in futures],
+                fill_value=self._fill_value,
+            )
 
 
 class FCPercentiles(StatsFCP):
@@ -63,12 +171,45 @@ class FCPercentiles(StatsFCP):
 
     This is a wrapper around :class:`odc.stats.plugins.fc_percentiles.StatsFCP`.
 
+    Args:
+        area_within_gadm: Whether the area passed to :meth:`process` lies
+            entirely within GADM, e.g. from :func:`grid.within_gadm`. If so,
+            masking to GADM is skipped.
+        **kwargs: Passed to :class:`odc.stats.plugins.fc_percentiles.StatsFCP`.
     """
 
     send_area_to_processor = True
     # These are those used for DE Africa
     BAD_BITS_MASK = {"cloud": 1 << 6, "cloud_shadow": 1 << 5}
 
+    def __init__(self, *, area_within_gadm: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.area_within_gadm = area_within_gadm
+
+    @cached_property
+    def _bad_bits_filters(self) -> dict[int, list[tuple[str, int]]]:
+        # The bitmasks in BAD_BITS_MASK which have cloud filters set, mapped
+        # to those filters. Other bits are not decoded at all.
+        # Dilating a union is the same as the union of the dilations, so
+        # bits with the same dilation-only filters are combined into one
+        # mask. This halves the number of masks (and dilations) when cloud
+        # and cloud shadow use the same filters.
+        groups = []
+        for key, bits in self.BAD_BITS_MASK.items():
+            mask_filters = self.cloud_filters.get(key)
+            if mask_filters is None:
+                continue
+            dilation_only = all(
+                operation == "dilation" for operation, _ in mask_filters
+            )
+            for group in groups:
+                if dilation_only and group[1] == mask_filters:
+                    group[0] |= bits
+                    break
+            else:
+                groups.append([bits, mask_filters])
+        return {bits: mask_filters for bits, mask_filters in groups}
+
     def native_transform(self, xx):
         """Transform data in preparation for summarisation.
 
@@ -83,24 +224,22 @@ class FCPercentiles(StatsFCP):
             "bs", "pv", "npv", and "ue".
         """
 
-        # not mask against bit 4: terrain high slope
-        # This is why a subclass was needed: without casting the bitmask to
-        # uint8, the inversion (~) created a negative number. It must
-        # compare to the left operand and has trouble with a dask array?
-        mask = xx["water"] & ~np.uint8(1 << 4)
-        # Pick out the dry and wet pixels
-        valid = mask == 0
-        wet = mask == 128
+        # Decode all the flags in a single pass over the WOfS band
+        bad_bits = self._bad_bits_filters
+        valid, wet, *raw_masks = apply_ufunc(
+            _decode_wofl,
+            xx["water"],
+            kwargs=dict(bad_bits=list(bad_bits)),
+            output_core_dims=[[]] * (2 + len(bad_bits)),
+            dask="parallelized",
+            output_dtypes=[bool] * (2 + len(bad_bits)),
+        )
 
         # dilate both 'valid' and 'water'
-        for key, val in self.BAD_BITS_MASK.items():
-            if self.cloud_filters.get(key) is not None:
-                raw_mask = (xx["water"] & val) > 0
-                raw_mask = mask_cleanup(
-                    raw_mask, mask_filters=self.cloud_filters.get(key)
-                )
-                valid &= ~raw_mask
-                wet &= ~raw_mask
+        for raw_mask, mask_filters in zip(raw_masks, bad_bits.values()):
+            raw_mask = mask_cleanup(raw_mask, mask_filters=mask_filters)
+            valid &= ~raw_mask
+            wet &= ~raw_mask
 
         xx = xx.drop_vars(["water"])
 
@@ -111,25 +250,30 @@ class FCPercentiles(StatsFCP):
         xx = xx.drop_vars(["ue"])
 
         # If there's a sum limit or clip range, implement these
-        if self.max_sum_limit is not None or self.clip_range is not None:
-            sum_bands = 0
-            for band in xx.data_vars.keys():
-                attributes = xx[band].attrs
-                mask = xx[band] == NODATA
-                band_data = keep_good_only(xx[band], ~mask, nodata=0)
-
-                if self.max_sum_limit is not None:
-                    sum_bands = sum_bands + band_data
-
-                if self.clip_range is not None:
-                    # No QA
-                    clipped = np.clip(xx[band], self.clip_range[0], self.clip_range[1])
-                    # Set masked values back to NODATA
-                    xx[band] = clipped.where(~mask, NODATA)
-                    xx[band].attrs = attributes
-
-            if self.max_sum_limit is not None:
-                valid &= sum_bands < self.max_sum_limit
+        if self.max_sum_limit is not None:
+            sum_bands = apply_ufunc(
+                _sum_valid,
+                *xx.data_vars.values(),
+                kwargs=dict(nodata=NODATA),
+                dask="parallelized",
+                output_dtypes=[np.uint16],
+            )
+            valid &= sum_bands < self.max_sum_limit
+
+        if self.clip_range is not None:
+            # No QA
+            xx = xx.map(
+                lambda band: apply_ufunc(
+                    _clip_valid,
+                    band,
+                    kwargs=dict(
+                        low=self.clip_range[0], high=self.clip_range[1], nodata=NODATA
+                    ),
+                    dask="parallelized",
+                    output_dtypes=[band.dtype],
+                ),
+                keep_attrs=True,
+            )
 
         xx = keep_good_only(xx, valid, nodata=NODATA)
         xx["wet"] = wet
@@ -145,20 +289,38 @@ class FCPercentiles(StatsFCP):
                 "pv", "npv" and "ue" (fractional cover variables) and
                 "water" (wofl data).
             area: The footprint of `input_ds`. If this is set, then the
-                data is masked to GADM using :func:`dep_tools.utils.mask_to_gadm`.
+                data is masked to GADM using :func:`dep_tools.utils.mask_to_gadm`,
+                unless `area_within_gadm` was set.
         Returns:
             Annual summaries of fractional cover.
         """
         transformed = self.native_transform(input_ds)
-        fused = transformed.groupby("time").apply(self.fuser)
+        # Fusing combines observations that share a timestamp, so a group
+        # with a single observation is returned unchanged. Only group when
+        # there are duplicates, as each group adds a separate subgraph.
+        if transformed.indexes["time"].is_unique:
+            fused = transformed
+        else:
+            # Give each group its own chunk along time so the groupby doesn't
+            # split chunks, which multiplies the number of tasks
+            transformed = transformed.sortby("time")
+            _, group_sizes = np.unique(transformed.time, return_counts=True)
+            transformed = transformed.chunk(time=tuple(group_sizes.tolist()))
+            fused = transformed.groupby("time").apply(self.fuser)
         output = self.reduce(fused)
-        if area is not None:
+        if area is not None and not self.area_within_gadm:
             output = mask_to_gadm(output, area)
 
-        # Ensure there's no stray nans, then convert to uint8
-        output = output.where(~output.isnull(), NODATA).astype("uint8")
-
         for var in output:
+            # Ensure there's no stray nans, then convert to uint8
+            output[var] = apply_ufunc(
+                _fill_nan,
+                output[var],
+                kwargs=dict(nodata=NODATA),
+                dask="parallelized",
+                output_dtypes=[np.uint8],
+                keep_attrs=True,
+            )
             output[var].rio.write_nodata(NODATA, inplace=True)
             output[var].attrs["nodata"] = NODATA
 
@@ -175,7 +337,7 @@ def main(
 ) -> None:
     boto3.setup_default_session()
     id = (column, row)
-    geobox = grid.loc[id]
+    geobox = get_geobox(id)
 
     itempath = S3ItemPath(
         bucket=BUCKET,
@@ -186,7 +348,7 @@ def main(
     )
 
     # fc and wofl are needed for all scenes
-    searcher = PystacSearcher(
+    searcher = MultiCollectionSearcher(
         catalog=f"https://stac.digitalearthpacific.org",
         datetime=datetime,
         collections=["dep_ls_fc", "dep_ls_wofl"],
@@ -201,6 +363,7 @@ def main(
     processor = FCPercentiles(
         cloud_filters=dict(cloud=[("dilation", 6)], cloud_shadow=[("dilation", 6)]),
         count_valid=True,
+        area_within_gadm=within_gadm(id),
     )
 
     post_processor = XrPostProcessor(
@@ -250,5 +413,24 @@ def main(
 
 
 if __name__ == "__main__":
-    with Client():
+    # Limit how far the loads can run ahead of the reductions, and spill
+    # to disk before workers run out of memory.
+    dask.config.set(
+        {
+            "distributed.scheduler.worker-saturation": 1.0,
+            "distributed.worker.memory.target": 0.6,
+            "distributed.worker.memory.spill": 0.7,
+            "distributed.worker.memory.pause": 0.85,
+        }
+    )
+    with Client() as client:
+        # Reads happen on the workers, so GDAL is configured there. This lets
+        # the fc and wofl reads share connections and the curl block cache.
+        configure_rio(
+            cloud_defaults=True,
+            CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".tif,.tiff",
+            CPL_VSIL_CURL_CACHE_SIZE=str(512 * 1024 * 1024),
+            GDAL_HTTP_MULTIPLEX="YES",
+            client=client,
+        )
         run(main)
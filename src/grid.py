@@ -1,18 +1,146 @@
-"""Define the grid used for fractional cover."""
+"""Define the grid used for fractional cover.
 
-from dep_tools.grids import grid, gadm
+`grid` (or :func:`summary_grid`) is built lazily on first access, and only
+holds the tile indices and whether each tile lies within GADM. Use :func:`get_geobox` to get the GeoBox for a single
+tile.
+"""
+
+from functools import lru_cache
+from importlib.metadata import PackageNotFoundError, version
+import os
+from pathlib import Path
+from tempfile import mkstemp
+import warnings
+
+from dep_tools.grids import gadm, grid as dep_grid
+from dep_tools.landsat_utils import landsat_grid as dep_landsat_grid
+from geopandas import GeoDataFrame
+from odc.geo import GeoBox
 import pandas as pd
 
-# Use for summary products.
-grid = pd.DataFrame.from_records(
-    grid(intersect_with=gadm()), columns=["index", "geobox"], index="index"
-)
-grid.index = pd.MultiIndex.from_tuples(grid.index)
-grid = grid.geobox
-# `grid` is a pandas Series indexed by a column,row MultiIndex:
-# 107  8     GeoBox((3200, 3200), Affine(30.0, 0.0, 7272000...
-# 108  8     GeoBox((3200, 3200), Affine(30.0, 0.0, 7368000...
-# 123  11    GeoBox((3200, 3200), Affine(30.0, 0.0, 8808000...
-# 125  12    GeoBox((3200, 3200), Affine(30.0, 0.0, 9000000...
-# 130  12    GeoBox((3200, 3200), Affine(30.0, 0.0, 9480000...
-# ...
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "dep-fc"
+
+
+def _cache_path(name: str) -> Path:
+    # The grids come from dep-tools, so a new version invalidates the cache
+    try:
+        dep_tools_version = version("dep-tools")
+    except PackageNotFoundError:
+        dep_tools_version = "unknown"
+    return CACHE_DIR / f"{name}-{dep_tools_version}.pkl"
+
+
+def _read_cache(path: Path):
+    if not path.exists():
+        return None
+    try:
+        return pd.read_pickle(path)
+    except Exception as e:
+        # e.g. a truncated file, or one pickled by other geopandas/shapely
+        # versions
+        warnings.warn(f"Could not read cached grid at {path}: {e}")
+        return None
+
+
+def _write_cache(path: Path, obj) -> None:
+    # Write to a temporary file and move it into place, so concurrent
+    # readers never see a partial file
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+        os.close(fd)
+        try:
+            obj.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except OSError as e:
+        warnings.warn(f"Could not cache grid at {path}: {e}")
+
+
+@lru_cache(maxsize=1)
+def _gridspec():
+    return dep_grid()
+
+
+@lru_cache(maxsize=4096)
+def get_geobox(id: tuple[int, int]) -> GeoBox:
+    """Get the GeoBox for a single tile.
+
+    Args:
+        id: The tile index as (column, row).
+    """
+    return _gridspec().tile_geobox(id)
+
+
+@lru_cache(maxsize=1)
+def landsat_grid() -> GeoDataFrame:
+    """The Landsat WRS-2 grid, from :func:`dep_tools.landsat_utils.landsat_grid`.
+
+    The grid is cached in memory and on disk under `CACHE_DIR`, so it is
+    only built once per machine and dep-tools version (or once per image,
+    see the Dockerfile).
+    """
+    path = _cache_path("landsat_grid")
+    grid = _read_cache(path)
+    if grid is None:
+        grid = dep_landsat_grid()
+        _write_cache(path, grid)
+    return grid
+
+
+def _within(geobox: GeoBox, land: GeoDataFrame) -> bool:
+    # Whether the tile lies entirely within a single GADM polygon
+    extent = geobox.extent.to_crs(land.crs).geom
+    return len(land.sindex.query(extent, predicate="within")) > 0
+
+
+@lru_cache(maxsize=1)
+def summary_grid() -> pd.DataFrame:
+    """The tiles of the DEP grid that intersect GADM, for summary products.
+
+    The index is a (column, row) MultiIndex. The only column,
+    "within_gadm", is True for tiles that lie entirely within GADM, so
+    that masking them to GADM would leave them unchanged, e.g.::
+
+                within_gadm
+        107  8        False
+        108  8        False
+        123  11        True
+        ...
+
+    Finding the tiles builds and tests a GeoBox for every tile in the grid,
+    so the result is cached in memory and on disk under `CACHE_DIR`.
+    """
+    path = _cache_path("summary_grid")
+    grid = _read_cache(path)
+    if grid is None or "within_gadm" not in grid:
+        land = gadm()
+        tiles = {
+            index: _within(geobox, land)
+            for index, geobox in dep_grid(intersect_with=land)
+        }
+        grid = pd.DataFrame(
+            dict(within_gadm=list(tiles.values())),
+            index=pd.MultiIndex.from_tuples(list(tiles.keys())),
+        )
+        _write_cache(path, grid)
+    return grid
+
+
+def within_gadm(id: tuple[int, int]) -> bool:
+    """Whether a summary tile lies entirely within GADM, so that masking it
+    to GADM would leave it unchanged.
+
+    Args:
+        id: The tile index as (column, row).
+    """
+    grid = summary_grid()
+    return id in grid.index and bool(grid.loc[id, "within_gadm"])
+
+
+def __getattr__(name):
+    if name == "grid":
+        return summary_grid()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,15 +1,15 @@
-import json
+from concurrent.futures import ThreadPoolExecutor
 import sys
-from itertools import product
 from typing import Annotated, Optional
 
+import orjson
+import pandas as pd
 import typer
 from cloud_logger import CsvLogger, filter_by_log, S3Handler
-from dep_tools.landsat_utils import landsat_grid
 from dep_tools.namers import S3ItemPath
 from dep_tools.parsers import bool_parser, datetime_parser
 
-from grid import grid as dep_grid
+from grid import landsat_grid, summary_grid
 from config import BUCKET, VERSION
 
 
@@ -23,12 +23,11 @@ def main(
     overwrite_existing_log: Annotated[str, typer.Option(parser=bool_parser)] = "False",
     filter_using_log: Annotated[str, typer.Option(parser=bool_parser)] = "True",
 ) -> None:
-    this_grid = dep_grid if grid == "dep" else landsat_grid()
+    this_grid = summary_grid() if grid == "dep" else landsat_grid()
     first_name = dict(dep="column", ls="path")
     second_name = dict(dep="row", ls="row")
 
-    params = list()
-    for year in years:
+    def year_params(year) -> pd.DataFrame:
         itempath = S3ItemPath(
             bucket=BUCKET,
             sensor="ls",
@@ -56,21 +55,22 @@ def main(
             else this_grid
         )
 
-        these_params = [
-            {
-                # we could take fromthe grid if we name the dep_grid multiindex
-                first_name[grid]: region[0][0],
-                second_name[grid]: region[0][1],
-                "year": region[1],
-            }
-            for region in product(grid_subset.index, [year])
-        ]
-        params += these_params
+        these_params = grid_subset.index.to_frame(
+            index=False, name=[first_name[grid], second_name[grid]]
+        )
+        these_params["year"] = year
+        return these_params
+
+    # Each year has its own log on S3, so read them concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        frames = list(executor.map(year_params, years))
+
+    params = pd.concat(frames).to_dict(orient="records")
 
     if limit is not None:
         params = params[0 : int(limit)]
 
-    json.dump(params, sys.stdout)
+    sys.stdout.buffer.write(orjson.dumps(params))
 
 
 if __name__ == "__main__":
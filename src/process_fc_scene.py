@@ -1,10 +1,17 @@
 """Create fractional cover for a single Landsat scene."""
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache, partial
+from math import ceil, log2, prod
+from os.path import commonprefix
 from pathlib import Path
+from threading import Lock
 import traceback
 import warnings
 
 import boto3
+from dask.array import empty
 from dep_tools.aws import object_exists, s3_dump
 from dep_tools.loaders import OdcLoader
 from dep_tools.namers import DailyItemPath
@@ -12,40 +19,140 @@ from dep_tools.task import AwsDsCogWriter, ItemStacTask
 from dep_tools.writers import AwsStacWriter
 from dep_tools.stac_utils import StacCreator
 from fc.virtualproduct import FractionalCover
+import numpy as np
 from pystac import Item
 from xarray import Dataset
 
-from config import BUCKET, DATASET_ID, OUTPUT_COLLECTION_ROOT, VERSION
+from config import BUCKET, DATASET_ID, OUTPUT_COLLECTION_ROOT, SCENE_WORKERS, VERSION
 
+# More chunks than this and the dask graph alone can exhaust memory
+MAX_CHUNKS = 1_000_000
 
-def process_fc_scene(item: Item, version=VERSION):
-    """Create fractional cover for a single Landsat scene.
 
-    The output data is saved to AWS S3.
+def _cap_chunks(item: Item, chunks: dict, n_bands: int) -> dict:
+    """Scale up spatial chunk sizes if loading `item` would create more than
+    MAX_CHUNKS chunks.
 
     Args:
-        item: A STAC Item for a single landsat scene.
-        tile_id: The landsat tile id as (path, row)
-        version: The output version.
+        item: The STAC Item to be loaded.
+        chunks: Chunk sizes as passed to the loader. -1 means the full extent.
+        n_bands: The number of bands to load.
 
+    Returns:
+        `chunks`, with "x" and "y" scaled up to the next power of two if needed.
     """
-    itempath = DailyItemPath(
+    shape = item.properties.get("proj:shape")
+    if shape is None:
+        return chunks
+
+    sizes = dict(zip(["y", "x"], shape))
+    scaled = [dim for dim in sizes if chunks[dim] > 0]
+    n_chunks = n_bands * prod(
+        ceil(size / chunks[dim]) for dim, size in sizes.items() if dim in scaled
+    )
+    if n_chunks <= MAX_CHUNKS or len(scaled) == 0:
+        return chunks
+
+    scale = (n_chunks / MAX_CHUNKS) ** (1 / len(scaled))
+    chunks = chunks | {
+        dim: min(2 ** ceil(log2(chunks[dim] * scale)), sizes[dim]) for dim in scaled
+    }
+    warnings.warn(
+        f"Auto-scaled chunks to (x={chunks['x']}, y={chunks['y']}) to keep the "
+        f"graph under {MAX_CHUNKS} chunks"
+    )
+    return chunks
+
+
+_S3_CLIENT_LOCK = Lock()
+
+
+@lru_cache(maxsize=1)
+def _create_s3_client():
+    # Creating clients from the default session is not thread safe
+    return boto3.Session().client("s3")
+
+
+def _s3_client():
+    # boto3 clients are thread safe but slow to create, so share one. The
+    # lock stops concurrent scene threads from each creating their own.
+    with _S3_CLIENT_LOCK:
+        return _create_s3_client()
+
+
+def _itempath(time: datetime, version: str) -> DailyItemPath:
+    return DailyItemPath(
         bucket=BUCKET,
         sensor="ls",
         dataset_id=DATASET_ID,
         version=version,
-        time=item.get_datetime(),
+        time=time,
     )
-    tile_id = (
+
+
+def _tile_id(item: Item) -> tuple:
+    return (
         item.properties["landsat:wrs_path"],
         item.properties["landsat:wrs_row"],
     )
-    if not object_exists(bucket=BUCKET, key=itempath.stac_path(tile_id)):
+
+
+def unprocessed_items(items: list[Item], version=VERSION) -> list[Item]:
+    """Drop the Landsat scenes that already have fractional cover on S3.
+
+    Existing outputs are found with a single listing under the common prefix
+    of the items' output keys, rather than a request per item.
+
+    Args:
+        items: STAC Items for Landsat scenes.
+        version: The output version.
+    """
+    items = list(items)
+    keys = [
+        _itempath(item.get_datetime(), version).stac_path(_tile_id(item))
+        for item in items
+    ]
+    if len(keys) == 0:
+        return []
+
+    existing = set()
+    paginator = _s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET, Prefix=commonprefix(keys)):
+        existing.update(content["Key"] for content in page.get("Contents", []))
+
+    return [item for item, key in zip(items, keys) if key not in existing]
+
+
+def process_fc_scene(item: Item, version=VERSION, check_exists=True):
+    """Create fractional cover for a single Landsat scene.
+
+    The output data is saved to AWS S3.
+
+    Args:
+        item: A STAC Item for a single landsat scene.
+        tile_id: The landsat tile id as (path, row)
+        version: The output version.
+        check_exists: Whether to skip the scene if output already exists.
+            Set to False if items have already been filtered, e.g. with
+            :func:`unprocessed_items`.
+
+    """
+    itempath = _itempath(item.get_datetime(), version)
+    tile_id = _tile_id(item)
+    if not check_exists or not object_exists(
+        bucket=BUCKET, key=itempath.stac_path(tile_id), client=_s3_client()
+    ):
         try:
+            bands = ["green", "red", "nir08", "swir16", "swir22"]
             loader = OdcLoader(
                 dtype="uint16",
-                bands=["green", "red", "nir08", "swir16", "swir22"],
-                chunks=dict(band=5, time=1, x=1024, y=1024),
+                bands=bands,
+                # Unmixing is per pixel, so there is no benefit to small
+                # chunks. Full width stripes keep the task count low while
+                # bounding memory.
+                chunks=_cap_chunks(
+                    item, dict(band=5, time=1, x=-1, y=2048), n_bands=len(bands)
+                ),
                 stac_cfg={
                     "landsat-c2l2-sr": {
                         "assets": {"*": {"nodata": 0}},
@@ -58,7 +165,15 @@ def process_fc_scene(item: Item, version=VERSION):
                 item=item,
                 loader=loader,
                 processor=FCProcessor(c2_scaling=True),
-                writer=AwsDsCogWriter(itempath),
+                # Write the four output bands in parallel. They all come from
+                # the same unmixing, so load first rather than recomputing it
+                # (and re-reading the input) for each band.
+                writer=AwsDsCogWriter(
+                    itempath,
+                    write_multithreaded=True,
+                    load_before_write=True,
+                    client=_s3_client(),
+                ),
                 stac_creator=StacCreator(
                     itempath,
                     collection_url_root=OUTPUT_COLLECTION_ROOT,
@@ -66,7 +181,7 @@ def process_fc_scene(item: Item, version=VERSION):
                     with_eo=True,
                     set_geometry_from_input=True,
                 ),
-                stac_writer=AwsStacWriter(itempath),
+                stac_writer=AwsStacWriter(itempath, client=_s3_client()),
             ).run()
 
         except Exception as e:
@@ -80,16 +195,49 @@ def process_fc_scene(item: Item, version=VERSION):
             warnings.warn(
                 f"Error while processing item. Log file copied to s3://{BUCKET}/{log_path}"
             )
-            boto3_client = boto3.client("s3")
-
             s3_dump(
                 data=traceback.format_exc(),
                 bucket=BUCKET,
                 key=str(log_path),
-                client=boto3_client,
+                client=_s3_client(),
             )
 
 
+def process_fc_scenes(items: list[Item], version=VERSION, process=process_fc_scene):
+    """Create fractional cover for the Landsat scenes that do not have it yet.
+
+    Scenes are independent, so `SCENE_WORKERS` of them are run at once.
+    Their computations share the dask cluster.
+
+    Args:
+        items: STAC Items for Landsat scenes.
+        version: The output version.
+        process: The function to run for each scene. It is called like
+            :func:`process_fc_scene`, which is the default.
+
+    Returns:
+        The result of `process` for each scene that was processed.
+    """
+    items = unprocessed_items(items, version=version)
+    with ThreadPoolExecutor(max_workers=SCENE_WORKERS) as executor:
+        return list(
+            executor.map(partial(process, version=version, check_exists=False), items)
+        )
+
+
+def _fc_template(data: Dataset, measurements: list) -> Dataset:
+    # The shape of the output of FCProcessor._compute_block, for map_blocks
+    like = data["nir"]
+    return Dataset(
+        {
+            m.name: (like.dims, empty(like.shape, dtype=np.uint8, chunks=like.chunks))
+            for m in measurements
+        },
+        coords=like.coords,
+        attrs=data.attrs,
+    )
+
+
 class FCProcessor(FractionalCover):
     """The Fractional Cover processor."""
 
@@ -109,13 +257,25 @@ class FCProcessor(FractionalCover):
             unsigned 8 bit integer with a nodata value of 255.
 
         """
-        data = (
-            data.rename(dict(nir08="nir", swir16="swir1", swir22="swir2"))
-            .assign_attrs(dict(crs=data.odc.crs))
-            .compute()
+        data = data.rename(
+            dict(nir08="nir", swir16="swir1", swir22="swir2")
+        ).assign_attrs(dict(crs=data.odc.crs))
+
+        # Unmixing is done per pixel, so run it on each chunk rather than
+        # loading the whole scene into memory first.
+        output = data.map_blocks(
+            self._compute_block, template=_fc_template(data, self.measurements)
         )
+        NODATA = 255
+        for var in output:
+            output[var].attrs["nodata"] = NODATA
+        return output
+
+    def _compute_block(self, data: Dataset) -> Dataset:
+        # The output is built from the GeoBox of each time slice, so the time
+        # coordinate is lost and has to be restored for map_blocks
+        output = self.compute(data).assign_coords(time=data.time)
 
-        output = super().compute(data)
         # To convert from int8 with nodata = -1 to uint8 with nodata=255
         # we have to do it this way. I tried to alter the "Measurements"
         # var in the fc code but there are places where -1 is hardcoded
@@ -123,14 +283,12 @@ class FCProcessor(FractionalCover):
         # Converting to uint8
         # 1. Makes it easier to load alongside WOfS when calculating percentiles
         # 2. matches DE Africa data
-        OLD_NODATA = -1
-        NODATA = 255
+        # -1 in two's complement int8 is 0xFF, which is 255 as uint8, so
+        # reinterpreting the bytes converts nodata without a copy
         for var in output:
-            output[var] = (
-                output[var]
-                .astype("int16")
-                .where(output[var] != OLD_NODATA, NODATA)
-                .astype("uint8")
-            )
-            output[var].attrs["nodata"] = NODATA
+            if output[var].dtype != np.int8:
+                raise TypeError(
+                    f"Expected int8 fractional cover, got {output[var].dtype} for {var}"
+                )
+            output[var] = output[var].copy(data=output[var].data.view(np.uint8))
         return output
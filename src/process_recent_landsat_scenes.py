@@ -1,33 +1,34 @@
 from datetime import datetime, timedelta, timezone
-import json
 import sys
 from typing_extensions import Annotated
 import warnings
 
 from distributed import Client
 from odc.stac import configure_s3_access
+import orjson
 import pystac_client
 from typer import Option, Typer
 
 from cloud_logger import CsvLogger
 from dep_tools.exceptions import EmptyCollectionError
-from dep_tools.landsat_utils import landsat_grid
 from dep_tools.namers import S3ItemPath
 from dep_tools.stac_utils import use_alternate_s3_href
 from dep_tools.utils import search_across_180
 
 from config import BUCKET, DATASET_ID, VERSION
-from process_fc_scene import process_fc_scene
+from grid import landsat_grid
+from process_fc_scene import process_fc_scenes
 
 app = Typer()
 
 
-@app.command()
-def list():
+@app.command("list")
+def list_tiles():
     """List all Landsat tiles."""
-    json.dump(
-        [{"path": pr[0], "row": pr[1]} for pr in landsat_grid().index.tolist()],
-        sys.stdout,
+    sys.stdout.buffer.write(
+        orjson.dumps(
+            [{"path": pr[0], "row": pr[1]} for pr in landsat_grid().index.tolist()]
+        )
     )
 
 
@@ -84,7 +85,7 @@ def process_tile(
         # Don't reraise, it just means there's no data
         return None
 
-    paths = [process_fc_scene(item, version=version) for item in items]
+    paths = process_fc_scenes(items, version=version)
 
     logger.info([id, "complete", paths])
 
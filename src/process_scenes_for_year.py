@@ -1,3 +1,4 @@
+from threading import Lock
 from typing_extensions import Annotated
 import warnings
 
@@ -8,13 +9,13 @@ from typer import Option, run
 
 from cloud_logger import CsvLogger
 from dep_tools.exceptions import EmptyCollectionError
-from dep_tools.landsat_utils import landsat_grid
 from dep_tools.namers import S3ItemPath
 from dep_tools.stac_utils import use_alternate_s3_href
 from dep_tools.utils import search_across_180
 
 from config import BUCKET, DATASET_ID, VERSION
-from process_fc_scene import process_fc_scene
+from grid import landsat_grid
+from process_fc_scene import process_fc_scene, process_fc_scenes
 
 
 def main(
@@ -77,14 +78,19 @@ def main(
         # Don't reraise, it just means there's no data
         return None
 
+    # Scenes run concurrently, and configuring access changes process-wide
+    # state, so only one scene does it at a time
+    auth_lock = Lock()
+
     def auth_and_process(*args, **kwargs):
         # Read auth seems to expire after 1hr.
         # Re-authenticate before each tile to get around this, as tasks
         # for all scenes within a year can take more than an hour.
-        configure_s3_access(cloud_defaults=True, requester_pays=True)
-        process_fc_scene(*args, **kwargs)
+        with auth_lock:
+            configure_s3_access(cloud_defaults=True, requester_pays=True)
+        return process_fc_scene(*args, **kwargs)
 
-    paths = [auth_and_process(item, version=version) for item in items]
+    paths = process_fc_scenes(items, version=version, process=auth_and_process)
 
     logger.info([id, "complete", paths])
 